@@ -263,12 +263,33 @@ software was developed as part of the CASICS project, the Comprehensive and
 Automated Software Inventory Creation System. For more, visit http://casics.org.
 '''
 
-from collections import defaultdict
-from math import pow, log, ceil
+from collections import Counter, defaultdict
+from itertools import product
+from math import log, ceil
+from operator import attrgetter
 import os
 import re
 import string
 import sys
+import unicodedata
+
+import numpy as np
+
+# Packages needed only by diagnostic functions (tabulate) are imported inside
+# those functions, and plac only by the command-line interface, so that
+# importing this module does not load them.
+
+try:
+    from .ng import NGramData
+except ImportError:
+    from ng import NGramData
+
+try:
+    from numba import njit, prange, get_num_threads
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    prange = range
+    _NUMBA_AVAILABLE = False
 
 
 # General n-gram functions.
@@ -279,18 +300,58 @@ def ngrams(s, n):
     return [s[i : i + n] for i in range(len(s) - n + 1)]
 
 
+def _ngram_ids(s, n, strict=True):
+    '''Return all n-grams of length 'n' for the given string 's' as a NumPy
+    array of integer ids.  Each n-gram of lower-case letters is packed as a
+    base-26 number (so 'aaaa' is 0, 'aaab' is 1, and so on), which means the
+    id of an n-gram is also its position in the list returned by
+    _all_possible_ngrams(n).  If 'strict' is True, the string must consist
+    only of lower-case letters; otherwise, n-grams containing any other
+    characters are given the id -1.
+    '''
+    if len(s) < n:
+        return np.zeros(0, dtype=np.int32)
+    letters = np.frombuffer(s.encode('ascii', errors='replace'), dtype=np.uint8)
+    letters = letters.astype(np.int32) - ord('a')
+    invalid = (letters < 0) | (letters > 25)
+    if strict and invalid.any():
+        raise ValueError('String contains characters other than a-z: {}'.format(s))
+    last = len(letters) - n + 1
+    ids = letters[:last].copy()
+    for i in range(1, n):
+        ids *= 26
+        ids += letters[i : last + i]
+    if not strict:
+        ids[np.convolve(invalid, np.ones(n, dtype=np.int32), 'valid') > 0] = -1
+    return ids
+
+
+def _ngram_id_batch(strings, n):
+    '''Return the n-gram ids (see _ngram_ids()) of all the strings in the
+    list 'strings' at once.  The result is a tuple (ids, starts, num_ngrams)
+    of NumPy arrays, where the ids of the n-grams in strings[k] are given by
+    ids[starts[k] : starts[k] + num_ngrams[k]].  As for _ngram_ids() with
+    'strict' False, n-grams containing characters other than a-z are given
+    the id -1.
+    '''
+    # Encode everything in one pass.  The separator is not a letter, so the
+    # n-grams spanning two strings get id -1 and are never referenced.
+    ids = _ngram_ids('\n'.join(strings), n, strict=False)
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    starts = np.zeros(len(strings), dtype=np.int64)
+    np.cumsum(lengths[:-1] + 1, out=starts[1:])
+    num_ngrams = np.maximum(lengths - n + 1, 0)
+    return ids, starts, num_ngrams
+
+
 def _all_possible_ngrams(n):
-    '''Recursively create all possible n-grams using lower case letters.'''
-    all_letters = string.ascii_lowercase
+    '''Create all possible n-grams using lower case letters.  They are
+    returned in alphabetical order, which is also the order of their ids as
+    computed by _ngram_ids().
+    '''
     if n == 0:
         return []
-    elif n == 1:
-        return [letter for letter in all_letters]
-    new_ngrams = []
-    for letter in all_letters:
-        for ngram in _all_possible_ngrams(n - 1):
-            new_ngrams.append(letter + ngram)
-    return new_ngrams
+    return [''.join(letters) for letters in product(string.ascii_lowercase, repeat=n)]
 
 
 # Functions to calculate scores for our modified TF-IDF.
@@ -314,19 +375,120 @@ def _ngram_idf_value(total_num_strings, string_frequency,
 
 
 def _highest_idf(ngram_freq):
-    '''Given a dictionary of n-gram score values for a corpus, returns the
-    highest IDF value of any n-gram.
+    '''Given a dictionary of n-gram score values for a corpus (or the
+    equivalent array produced by _ngram_array()), returns the highest IDF
+    value of any n-gram.
     '''
+    if isinstance(ngram_freq, np.ndarray):
+        return float(ngram_freq[0].max())
     return max(ngram_freq[n].idf for n in ngram_freq.keys())
 
 
 def _highest_total_frequency(ngram_freq):
-    '''Given a dictionary of n-gram score values for a corpus, returns the
-    highest total frequency of any n-gram.
+    '''Given a dictionary of n-gram score values for a corpus (or the
+    equivalent array produced by _ngram_array()), returns the highest total
+    frequency of any n-gram.
     '''
+    if isinstance(ngram_freq, np.ndarray):
+        return float(ngram_freq[1].max())
     return max(ngram_freq[n].total_frequency for n in ngram_freq.keys())
 
 
+def _ngram_array(ngram_freq):
+    '''Given a dictionary of n-gram score values for a corpus, returns the
+    values as a dense 2-row NumPy array with one column per n-gram id (see
+    _ngram_ids()).  Row 0 holds the IDF values and row 1 holds the total
+    frequencies.  N-grams missing from the dictionary are given the highest
+    IDF value and a total frequency of 0.  N-grams with characters other
+    than a-z (which dictionaries trained on raw identifiers can contain) are
+    left out, since they have no id and cannot occur in a scored string.
+    '''
+    ngram_length = len(next(iter(ngram_freq.keys())))
+    keys = ''.join(ngram_freq.keys())
+    if _nonletter_re.search(keys) or len(keys) != ngram_length*len(ngram_freq):
+        ngram_freq = {k: v for k, v in ngram_freq.items()
+                      if len(k) == ngram_length and not _nonletter_re.search(k)}
+        keys = ''.join(ngram_freq.keys())
+    letters = np.frombuffer(keys.encode('ascii'), dtype=np.uint8).reshape(-1, ngram_length)
+    ids = (letters.astype(np.int32) - ord('a')) @ (26 ** np.arange(ngram_length - 1, -1, -1))
+    values = ngram_freq.values()
+    idf = np.fromiter(map(attrgetter('idf'), values), dtype=np.float32,
+                      count=len(values))
+    total_freq = np.fromiter(map(attrgetter('total_frequency'), values),
+                             dtype=np.float32, count=len(values))
+    table = np.zeros((2, 26**ngram_length), dtype=np.float32)
+    table[0] = idf.max()
+    table[0, ids] = idf
+    table[1, ids] = total_freq
+    return table
+
+
+def _ngram_id_frequencies(strings, n, per_string=False, chunk_size=100000):
+    '''Given a list of lower-case strings, returns an array indexed by n-gram
+    id (see _ngram_ids()) of the number of times each n-gram occurs across
+    all of the strings.  If 'per_string' is True, an n-gram is counted at
+    most once per string, so that the values are the number of strings in
+    which each n-gram appears.  The strings are processed 'chunk_size' at a
+    time, to limit the memory used.
+    '''
+    freq = np.zeros(26**n, dtype=np.int64)
+    for start in range(0, len(strings), chunk_size):
+        chunk = strings[start : start + chunk_size]
+        if _NUMBA_AVAILABLE:
+            ids, starts, num_ngrams = _ngram_id_batch(chunk, n)
+            freq += _jit_ngram_id_frequencies(ids, starts, num_ngrams, 26**n,
+                                              per_string, get_num_threads())
+            continue
+        # Join the strings using a non-letter, so that n-grams spanning two
+        # strings get marked as invalid.
+        ids = _ngram_ids('\n'.join(chunk), n, strict=False)
+        valid = ids >= 0
+        if per_string:
+            # Tag each n-gram with the index of its string & drop duplicates.
+            lengths = np.fromiter((len(s) + 1 for s in chunk), dtype=np.int64,
+                                  count=len(chunk))
+            string_index = np.repeat(np.arange(len(chunk)), lengths)[:len(ids)]
+            keys = np.sort(string_index[valid] * 26**n + ids[valid])
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = keys[1:] != keys[:-1]
+            freq += np.bincount(keys[first] % 26**n, minlength=26**n)
+        else:
+            freq += np.bincount(ids[valid], minlength=26**n)
+    return freq
+
+
+def _jit_ngram_id_frequencies(ids, starts, num_ngrams, num_ids, per_string,
+                              num_blocks):
+    '''Compiled equivalent of _ngram_id_frequencies() for one chunk of
+    strings encoded by _ngram_id_batch().  The strings are split into
+    'num_blocks' blocks that are counted in parallel, each into its own
+    array, and the arrays are summed at the end.  N-grams with id -1 are
+    skipped.
+    '''
+    num_blocks = max(1, min(num_blocks, len(starts)))
+    block_size = (len(starts) + num_blocks - 1) // num_blocks
+    block_freq = np.zeros((num_blocks, num_ids), dtype=np.int64)
+    for b in prange(num_blocks):
+        freq = block_freq[b]
+        # Marks the n-grams already counted for the current string.
+        seen = np.zeros(num_ids, dtype=np.bool_)
+        for k in range(b * block_size, min(len(starts), (b + 1) * block_size)):
+            string_ids = ids[starts[k] : starts[k] + num_ngrams[k]]
+            for ngram in string_ids:
+                if ngram < 0 or (per_string and seen[ngram]):
+                    continue
+                seen[ngram] = per_string
+                freq[ngram] += 1
+            if per_string:
+                for ngram in string_ids:
+                    if ngram >= 0:
+                        seen[ngram] = False
+    return block_freq.sum(axis=0)
+
+if _NUMBA_AVAILABLE:
+    _jit_ngram_id_frequencies = njit(cache=True, parallel=True)(_jit_ngram_id_frequencies)
+
+
 def _ngram_values(string_list, n, readjust_zero_scores=True):
     '''Given the corpus of strings in 'string_list', computes n-gram
     statistics across the corpus.  Returns the results as a dictionary
@@ -353,69 +515,240 @@ def _ngram_values(string_list, n, readjust_zero_scores=True):
     looking at the string_frequency field of the NGramData tuple for that
     n-gram, so we do not really lose any information by doing this.)
     '''
-    counts = defaultdict(int)
-    occurrences = defaultdict(set)
-    num_strings = 0
-    for s in string_list:
-        s = s.lower()
-        num_strings += 1
-        for ngram in ngrams(s, n):
-            occurrences[ngram].add(s)
-            counts[ngram] += 1
-    # Set initial values for all n-grams.
-    all_ngrams = defaultdict.fromkeys(_all_possible_ngrams(n),
-                                      NGramData(string_frequency=0,
-                                                total_frequency=0,
-                                                idf=0))
-    # Set n-gram values based on occurrences in the corpus.
-    max_frequency = max([count for ngram, count in counts.items()])
-    for ngram, string_list in occurrences.items():
-        string_freq = len(string_list)
-        total_freq = counts[ngram]
-        score = _ngram_idf_value(num_strings, string_freq, total_freq, max_frequency)
-        all_ngrams[ngram] = NGramData(string_frequency=string_freq,
-                                      total_frequency=total_freq,
-                                      idf=score)
+    # Only case is folded here.  Characters other than a-z are not deleted,
+    # because n-grams that span them are skipped when counting rather than
+    # joined across.  (Deleting them would manufacture n-grams not present
+    # in the corpus.)
+    strings = [s.lower() for s in string_list]
+    num_strings = len(strings)
+    total_freq = _ngram_id_frequencies(strings, n)
+    # String frequencies count distinct strings, not repeats of a string.
+    string_freq = _ngram_id_frequencies(list(dict.fromkeys(strings)), n,
+                                        per_string=True)
+    # Compute IDF values for the n-grams that occur in the corpus; the rest
+    # are left at 0.
+    max_frequency = int(total_freq.max())
+    present = np.flatnonzero(total_freq)
+    idf = np.zeros(26**n)
+    idf[present] = [_ngram_idf_value(num_strings, string_count, total_count, max_frequency)
+                    for string_count, total_count
+                    in zip(string_freq[present].tolist(), total_freq[present].tolist())]
     # Now that we've seen all n-grams actually present in the corpus, go back
     # and set those that have 0 values to a very high value (=> rare n-gram).
     if readjust_zero_scores:
-        max_idf = ceil(_highest_idf(all_ngrams))
-        for ngram, value in all_ngrams.items():
-            if value.idf == 0:
-                # Can't set a value in an existing tuple; must regenerate tuple
-                all_ngrams[ngram] = NGramData(string_frequency=0,
-                                              total_frequency=0,
-                                              idf=max_idf)
-    return all_ngrams
+        zero = idf == 0
+        idf[zero] = ceil(idf.max())
+        string_freq[zero] = 0
+        total_freq[zero] = 0
+    ngram_freq = defaultdict(None, zip(_all_possible_ngrams(n),
+                                       map(NGramData, string_freq.tolist(),
+                                           total_freq.tolist(), idf.tolist())))
+    return ngram_freq
+
+
+def _jit_score(ids, idf_arr, counts, idf_unit, tf_scale, len_threshold,
+               len_penalty_exp, repetition_penalty_exp, len_pow, rep_pow):
+    '''Compute the score of a string from the array of its n-gram ids, using
+    the formula described in _tfidf_score_function().  The IDF values in
+    'idf_arr' are in units of 'idf_unit', so that they can be stored as
+    16-bit integers.  'counts' must be an array of zeros with the same size
+    as 'idf_arr'; it is used as scratch space for counting n-grams and is
+    left zeroed again on return.  The value of 'tf_scale' is 0.5/max_freq,
+    so that the TF term can be computed as 0.5 + tf_scale*c without a
+    division.  The arrays 'len_pow' and 'rep_pow' are tables of
+    x**len_penalty_exp and x**repetition_penalty_exp for small integers x,
+    so that the powers only need to be computed for values beyond the ends
+    of the tables.  The contents of 'ids' are overwritten.  This is
+    compiled with Numba when it is available.
+    '''
+    # Count occurrences, recording each distinct n-gram the first time it's
+    # seen so that only those entries need to be visited (and reset) below.
+    # They are recorded over the start of 'ids', which is safe because
+    # entry i is read before any entry after i-1 is written.
+    touched = ids
+    num_touched = 0
+    for i in range(len(ids)):
+        ngram = ids[i]
+        if counts[ngram] == 0:
+            touched[num_touched] = ngram
+            num_touched += 1
+        counts[ngram] += 1
+    # The loads from idf_arr below are random but independent of each other,
+    # so the CPU overlaps them without help; the table (1.8 MB for 4-grams)
+    # also fits in L2 cache.  Software prefetching ids a few iterations ahead
+    # was tried and measured to be slightly slower, so it is not done here.
+    score = 0.0
+    for i in range(num_touched):
+        ngram = touched[i]
+        c = counts[ngram]
+        counts[ngram] = 0
+        if c < len(rep_pow):
+            repetition_penalty = rep_pow[c]
+        else:
+            repetition_penalty = c**repetition_penalty_exp
+        score += idf_arr[ngram] * repetition_penalty * (0.5 + tf_scale*c)
+    num_ngrams = len(ids)
+    excess = max(0, num_ngrams - len_threshold)
+    if excess < len(len_pow):
+        length_penalty = len_pow[excess]
+    else:
+        length_penalty = excess**len_penalty_exp
+    return (score*idf_unit + length_penalty)/(1 + num_ngrams)
+
+
+def _jit_score_chars(chars, ids, n, idf_arr, counts, idf_unit, tf_scale,
+                     len_threshold, len_penalty_exp, repetition_penalty_exp,
+                     len_pow, rep_pow):
+    '''Compute the score of one string of n-grams of length 'n' from its
+    ASCII codes in 'chars' (see _ascii_codes()), folding upper-case letters
+    to lower case and skipping anything that is not a letter.  'ids' must be
+    an int32 array at least as long as 'chars', which is used as scratch
+    space, so that nothing needs to be allocated per string.  The remaining
+    arguments are as for _jit_score().  This is compiled with Numba when it
+    is available, and is meant to be called from the kernels made by
+    _jit_score_kernels().
+    '''
+    # Setting bit 5 lower-cases letters, and maps no other character into
+    # the range a-z.
+    num_letters = 0
+    for c in chars:
+        c |= 0x20
+        if c >= 97 and c <= 122:
+            ids[num_letters] = c - 97
+            num_letters += 1
+    # Pack the letters of each n-gram into its id.  This can be done in
+    # place, as the id of the n-gram at i only needs letters from i on.
+    num_ngrams = max(0, num_letters - n + 1)
+    for i in range(num_ngrams):
+        ngram = 0
+        for j in range(n):
+            ngram = ngram*26 + ids[i + j]
+        ids[i] = ngram
+    return _jit_score(ids[:num_ngrams], idf_arr, counts, idf_unit, tf_scale,
+                      len_threshold, len_penalty_exp, repetition_penalty_exp,
+                      len_pow, rep_pow)
+
+
+def _jit_score_kernels(n):
+    '''Return a tuple of two functions (score, score_batch) specialized for
+    n-grams of length 'n'.  They are generated at run time so that Numba
+    compiles them with 'n' as a constant, which lets the loop that packs
+    each n-gram's letters into its id be fully unrolled once
+    _jit_score_chars() is inlined into them.
+
+    score(chars, ids, ...) computes the score of one string, as
+    _jit_score_chars() does.  score_batch(chars, starts, lengths, ...)
+    computes the scores of a batch of strings encoded by _ascii_code_batch()
+    and returns them as a NumPy array.  Both take the remaining arguments of
+    _jit_score() after 'ids', except that for score_batch(), 'counts' is a
+    2-D array with one row of scratch space for each block of strings to be
+    scored in parallel.  The functions are created once per value of 'n'.
+    They close over nothing but 'n', so that Numba's on-disk cache of their
+    compiled code is found again by later processes.
+    '''
+    if n in _score_kernels:
+        return _score_kernels[n]
+    def score(chars, ids, idf_arr, counts, idf_unit, tf_scale, len_threshold,
+              len_penalty_exp, repetition_penalty_exp, len_pow, rep_pow):
+        return _jit_score_chars(chars, ids, n, idf_arr, counts, idf_unit,
+                                tf_scale, len_threshold, len_penalty_exp,
+                                repetition_penalty_exp, len_pow, rep_pow)
+    score = njit(cache=True, fastmath=True)(score)
+
+    def score_batch(chars, starts, lengths, idf_arr, counts, idf_unit,
+                    tf_scale, len_threshold, len_penalty_exp,
+                    repetition_penalty_exp, len_pow, rep_pow):
+        scores = np.empty(len(starts))
+        num_blocks = max(1, min(len(counts), len(starts)))
+        block_size = (len(starts) + num_blocks - 1) // num_blocks
+        max_length = lengths.max() if len(lengths) else 0
+        for b in prange(num_blocks):
+            ids = np.empty(max_length, dtype=np.int32)
+            for k in range(b * block_size, min(len(starts), (b + 1) * block_size)):
+                string_chars = chars[starts[k] : starts[k] + lengths[k]]
+                scores[k] = _jit_score_chars(string_chars, ids, n, idf_arr,
+                                             counts[b], idf_unit, tf_scale,
+                                             len_threshold, len_penalty_exp,
+                                             repetition_penalty_exp, len_pow,
+                                             rep_pow)
+        return scores
+    score_batch = njit(cache=True, fastmath=True, parallel=True)(score_batch)
+
+    _score_kernels[n] = (score, score_batch)
+    return _score_kernels[n]
+
+_score_kernels = {}
+
+if _NUMBA_AVAILABLE:
+    _jit_score = njit(cache=True, fastmath=True)(_jit_score)
+    # Inlined at the level of Numba's IR, so that the kernels calling it
+    # compile it with their constant value of 'n'.
+    _jit_score_chars = njit(cache=True, fastmath=True,
+                            inline='always')(_jit_score_chars)
 
 
 # When using n-gram scoring, we delete everything other than alpha characters.
-# (This is not used in the simple filters, only in the n-gram method.)
-
-_delchars = str.maketrans('', '', string.punctuation + string.digits + ' ')
+# (This is not used in the simple filters, only in the n-gram method.)  The
+# translation also folds upper-case ASCII letters to lower case.  Any other
+# characters cannot be scored.
+
+_delchars = str.maketrans(string.ascii_uppercase, string.ascii_lowercase,
+                          string.punctuation + string.digits + ' ')
+_nonletter_re = re.compile(r'[^a-z]')
+_unscorable_re = re.compile('[^a-zA-Z{}]'.format(
+    re.escape(string.punctuation + string.digits + ' ')))
+
+def _ascii_codes(s):
+    '''Return the ASCII codes of the characters in 's' as a NumPy array.  The
+    compiled scoring kernels do the equivalent of translating with _delchars
+    themselves.  Raises ValueError if 's' has any characters that cannot be
+    scored.
+    '''
+    if _unscorable_re.search(s):
+        raise ValueError('String contains characters that cannot be scored: {}'.format(s))
+    return np.frombuffer(s.encode('ascii'), dtype=np.uint8)
+
+def _ascii_code_batch(strings):
+    '''Return the ASCII codes (see _ascii_codes()) of all the strings in the
+    list 'strings' at once.  The result is a tuple (chars, starts, lengths)
+    of NumPy arrays, where the codes for strings[k] are given by
+    chars[starts[k] : starts[k] + lengths[k]].
+    '''
+    text = ''.join(strings)
+    if _unscorable_re.search(text):
+        bad = next(s for s in strings if _unscorable_re.search(s))
+        raise ValueError('String contains characters that cannot be scored: {}'.format(bad))
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    starts = np.zeros(len(strings), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return np.frombuffer(text.encode('ascii'), dtype=np.uint8), starts, lengths
 
 def _tfidf_score_function(ngram_freq, len_threshold=25, len_penalty_exp=1.365,
-                          repetition_penalty_exp=1.159):
+                          repetition_penalty_exp=1.159, batch=False):
     '''Generate a function (as a closure) that computes a score for a given
     string.  This needs to be called to create the function like this:
         score_string = _tfidf_score_function(...args...)
     The resulting scoring function can be called to score a string like this:
         score = score_string('yourstring')
+    If 'batch' is True, the function created instead takes a list of strings
+    and returns a NumPy array of their scores.  This is much faster than
+    scoring the strings one at a time when there are many of them.
     The formula implemented is as follows:
 
         S = a string to be scored (not given here, but to the function created)
 
-        ngram_freq = table of NGramData named tuples
+        ngram_freq = table of NGramData named tuples (or the equivalent array
+                     produced by _ngram_array())
         ngram_length = the "n" in n-grams
         max_freq = max frequency of any n-gram
         num_ngrams = number of (any) n-grams of length n in S
-        length_penalty = pow(max(0, num_ngrams - len_threshold), len_penalty_exp)
+        length_penalty = max(0, num_ngrams - len_threshold)**len_penalty_exp
         ngram_score_sum = 0
         for every n-gram in S:
             c = count of times the n-gram appears in S
             idf = IDF score of n-gram from ngram_freq
             tf = 0.5 + 0.5*( c/max_freq )
-            repetition_penalty = pow(c, repetition_penalty_exp)
+            repetition_penalty = c**repetition_penalty_exp
             ngram_score_sum += (tf * idf * repetition_penalty)
         final score = (ngram_score_sum + length_penalty)/(1 + num_ngrams)
 
@@ -451,23 +784,90 @@ def _tfidf_score_function(ngram_freq, len_threshold=25, len_penalty_exp=1.365,
     dictionary is faster than taking the length of a string -- this approach
     is just an optimization.
     '''
-    max_freq = _highest_total_frequency(ngram_freq)
-    ngram_length = len(next(iter(ngram_freq.keys())))
+    if isinstance(ngram_freq, np.ndarray):
+        table = ngram_freq
+    else:
+        table = _ngram_array(ngram_freq)
+    # IDF values are small (about 4-21 for the shipped data), so they're
+    # stored as 16-bit fixed-point numbers, halving the size of the table
+    # that is randomly accessed while scoring.  A power-of-2 unit is chosen
+    # to give as many fractional bits as the largest value allows.  For the
+    # shipped data, this moves scores by less than 2e-4, which changed the
+    # result for 1 of a million random test strings.  IDF values can be 0 or
+    # negative for small training sets, so the unit is sized by magnitude.
+    max_abs_idf = float(np.abs(table[0]).max())
+    if max_abs_idf > 0:
+        idf_unit = float(2.0**-np.floor(np.log2(32767/max_abs_idf)))
+    else:
+        idf_unit = 1.0
+    idf_arr = np.round(table[0]/idf_unit).astype(np.int16)
+    max_freq = _highest_total_frequency(table)
+    # Precomputed so that the TF term needs a multiplication, not a division.
+    # A table with no n-gram counts at all (which readjust_zero_scores gives
+    # when every IDF value is 0) has no TF term to scale.
+    tf_scale = 0.5/max_freq if max_freq > 0 else 0.0
+    ngram_length = round(log(len(idf_arr), 26))
     len_threshold = int(len_threshold)
-    def score_function(s):
-        # We only score alpha characters.
-        s = s.translate(_delchars)
-        # Generate list of n-grams for the given string.
-        string_ngrams = ngrams(s, ngram_length)
-        # Count up occurrences of each n-gram in the string.
-        ngram_counts = defaultdict(int)
-        for ngram in string_ngrams:
-            ngram_counts[ngram] += 1
-        num_ngrams = len(string_ngrams)
-        length_penalty = pow(max(0, num_ngrams - len_threshold), len_penalty_exp)
-        score = sum(ngram_freq[n].idf * pow(c, repetition_penalty_exp) * (0.5 + 0.5*c/max_freq)
-                    for n, c in ngram_counts.items()) + length_penalty
-        return score/(1 + num_ngrams)
+    len_penalty_exp = float(len_penalty_exp)
+    repetition_penalty_exp = float(repetition_penalty_exp)
+    if _NUMBA_AVAILABLE:
+        # Scratch space for counting n-grams, with a row for each block of
+        # strings that the batch function scores in parallel.
+        counts = np.zeros((get_num_threads() if batch else 1, len(idf_arr)),
+                          dtype=np.int32)
+        # Counts of n-grams in a string and the number of n-grams beyond the
+        # length threshold are small integers, so tabulate their powers.
+        rep_pow = np.power(np.arange(256, dtype=np.float64), repetition_penalty_exp)
+        len_pow = np.power(np.arange(512, dtype=np.float64), len_penalty_exp)
+        # The kernels take the string's bytes directly, which avoids the
+        # overhead of the NumPy calls in _ngram_ids().
+        score, score_batch = _jit_score_kernels(ngram_length)
+        # Scratch space for n-gram ids, replaced by a larger one if needed.
+        # Sharing it and 'counts' between threads is safe only because the
+        # kernels hold the GIL, so that calls to them never overlap.  Each
+        # call uses the buffer it checked the size of, even if another
+        # thread replaces 'ids' meanwhile.
+        ids = np.empty(256, dtype=np.int32)
+        def score_function(s):
+            nonlocal ids
+            buf = ids
+            if len(s) > len(buf):
+                buf = ids = np.empty(2*len(s), dtype=np.int32)
+            return score(_ascii_codes(s), buf, idf_arr, counts[0], idf_unit,
+                         tf_scale, len_threshold, len_penalty_exp,
+                         repetition_penalty_exp, len_pow, rep_pow)
+        def batch_score_function(strings):
+            chars, starts, lengths = _ascii_code_batch(strings)
+            return score_batch(chars, starts, lengths, idf_arr, counts,
+                               idf_unit, tf_scale, len_threshold,
+                               len_penalty_exp, repetition_penalty_exp,
+                               len_pow, rep_pow)
+        # Trigger compilation now, so that the first real call is not slow.
+        if batch:
+            batch_score_function(['a' * ngram_length])
+        else:
+            score_function('a' * ngram_length)
+    else:
+        def score_function(s):
+            # We only score alpha characters.  Strings from the nonsense
+            # detector are already clean, so skip the translation for them.
+            if _nonletter_re.search(s):
+                s = s.translate(_delchars)
+            # Generate the n-gram ids for the given string.
+            string_ngrams = _ngram_ids(s, ngram_length)
+            # Count up occurrences of each n-gram in the string.
+            ngram_counts = Counter(string_ngrams.tolist())
+            num_ngrams = len(string_ngrams)
+            length_penalty = max(0, num_ngrams - len_threshold)**len_penalty_exp
+            ids = list(ngram_counts.keys())
+            c = np.fromiter(ngram_counts.values(), dtype=np.float64, count=len(ids))
+            weights = np.power(c, repetition_penalty_exp) * (0.5 + tf_scale*c)
+            score = float(np.dot(idf_arr[ids], weights))*idf_unit + length_penalty
+            return score/(1 + num_ngrams)
+        def batch_score_function(strings):
+            return np.array([score_function(s) for s in strings], dtype=np.float64)
+    if batch:
+        return batch_score_function
     return score_function
 
 
@@ -585,14 +985,19 @@ def _simple_real(text):
 # rated as nonsense when it shouldn't be.  The approach now is to ignore non-
 # alphabetic characters.
 
-_nonalpha = string.punctuation + string.whitespace + string.digits
-_delete_nonalpha = str.maketrans('', '', _nonalpha)
+# Table for bytes.translate() that lower-cases ASCII letters, and the bytes
+# that it should delete (everything else), so that both happen in one pass.
+_lowercase = bytes.maketrans(string.ascii_uppercase.encode(),
+                             string.ascii_lowercase.encode())
+_nonalpha = bytes(set(range(256)) - set(string.ascii_letters.encode()))
 
 def sanitize_string(s):
-    # Translate non-ASCII character codes.
-    s = s.encode('mbcs', errors='ignore').decode()
+    # Translate non-ASCII character codes: accented letters become their
+    # base letters, and anything else outside ASCII is dropped.
+    if not s.isascii():
+        s = unicodedata.normalize('NFKD', s)
     # Lower-case the string & strip non-alpha.
-    return s.lower().translate(_delete_nonalpha)
+    return s.encode('ascii', errors='ignore').translate(_lowercase, _nonalpha).decode()
 
 
 def generate_nonsense_detector(ngram_freq=None,
@@ -600,7 +1005,8 @@ def generate_nonsense_detector(ngram_freq=None,
                                pickle_file='ngram_data.pklz',
                                score_len_threshold=25,
                                score_len_penalty_exp=0.9233,
-                               score_rep_penalty_exp=0.9674):
+                               score_rep_penalty_exp=0.9674,
+                               batch=False):
     '''Returns (as a closure) a function that can take a single argument and
     return True if a given string is gibberish and False otherwise.  Usage:
 
@@ -613,18 +1019,53 @@ def generate_nonsense_detector(ngram_freq=None,
 
     If not given a value for ngram_freq, it will look in the current
     directory for a pickled data file.  The name of the file is given by
-    the argument 'pickle_file'.
+    the argument 'pickle_file'.  The first time a pickle file is used, its
+    contents are converted to a NumPy array and saved next to it in a file
+    with the extension ".npy", which is loaded instead from then on.
+
+    If 'batch' is True, the function returned instead takes a list of
+    strings and returns a NumPy array of Boolean values, one per string.
+    This is much faster than testing the strings one at a time when there
+    are many of them to test.  The array is a masked array (see numpy.ma),
+    in which the values for strings that are too short to test are masked.
     '''
-    if not ngram_freq:
+    if ngram_freq is None or len(ngram_freq) == 0:
         file = _full_path(pickle_file)
         if not os.path.exists(file):
             raise ValueError('Cannot find pickle file {}'.format(file))
-        ngram_freq = dataset_from_pickle(file)
+        ngram_freq = _ngram_array_from_pickle(file)
     string_score = _tfidf_score_function(ngram_freq,
                                         len_threshold=score_len_threshold,
                                         len_penalty_exp=score_len_penalty_exp,
-                                        repetition_penalty_exp=score_rep_penalty_exp)
-    if trace:
+                                        repetition_penalty_exp=score_rep_penalty_exp,
+                                        batch=batch)
+    if batch:
+        def nonsense_detector(strings, show=trace):
+            strings = [sanitize_string(s) for s in strings]
+            too_short = [len(s) < min_length for s in strings]
+            real = [not t and _simple_real(s) for s, t in zip(strings, too_short)]
+            junk = [not (t or r) and _simple_nonsense(s)
+                    for s, t, r in zip(strings, too_short, real)]
+            to_score = [i for i in range(len(strings))
+                        if not (too_short[i] or real[i] or junk[i])]
+            scores = string_score([strings[i] for i in to_score])
+            results = np.array(junk, dtype=bool)
+            results[to_score] = scores > min_score
+            if show:
+                score_of = dict(zip(to_score, scores))
+                for i, s in enumerate(strings):
+                    if too_short[i]:
+                        continue
+                    elif real[i]:
+                        _msg('"{}" matched simple acceptance rule'.format(s))
+                    elif junk[i]:
+                        _msg('"{}" matched simple rejection rule'.format(s))
+                    else:
+                        _msg('"{}": {} (score {:.4f} threshold {:.4f})'
+                             .format(s, 'y' if results[i] else 'n',
+                                     score_of[i], min_score))
+            return np.ma.masked_array(results, mask=too_short)
+    elif trace:
         def nonsense_detector(s, show=trace):
             s = sanitize_string(s)
             if len(s) < min_length:
@@ -681,6 +1122,29 @@ def dataset_from_pickle(file):
         return pickle.load(pickle_file)
 
 
+def _ngram_array_from_pickle(file):
+    '''Return the n-gram data in the compressed pickle file 'file' in the form
+    produced by _ngram_array().  The array is cached in a ".npy" file next to
+    'file', and if the cache is up to date, it is memory-mapped from there
+    instead of reading the pickle file.
+    '''
+    cache = os.path.splitext(file)[0] + '.npy'
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(file):
+        return np.load(cache, mmap_mode='r')
+    table = _ngram_array(dataset_from_pickle(file))
+    try:
+        # Write to a temporary file first, so that concurrent readers never
+        # see a partially-written cache file.
+        temp = '{}.{}.tmp'.format(cache, os.getpid())
+        with open(temp, 'wb') as f:
+            np.save(f, table)
+        os.replace(temp, cache)
+    except OSError:
+        # We can still work without the cache, e.g., in read-only installs.
+        pass
+    return table
+
+
 def dataset_to_pickle(file, data_set):
     '''Save the contents of 'data_set' to the compressed pickle file 'file'.
     The pickle is assumed to contain only one data structure.
@@ -731,7 +1195,7 @@ def _msg(text):
 # .............................................................................
 
 def test_unlabeled(input, nonsense_tester, min_length=6, sense='valid',
-                   trace_scores=False, save_to=None):
+                   trace_scores=False, save_to=None, batch=False):
     '''Test against a file or list of strings.  'nonsense_tester' is a
     function that should return True if a given string is nonsense.  'sense'
     indicates whether each input string should be considerd to be a valid
@@ -742,8 +1206,14 @@ def test_unlabeled(input, nonsense_tester, min_length=6, sense='valid',
     that are shorter than 'min_length' are skipped.  This function returns a
     tuple of totals and the time it took: (num_failures, num_successes,
     num_tested, num_skipped, elapsed_time) If the argument 'save_to' is not
-    None, then it is assumed to be a filename and any and all stdout output
-    will be redirected to the file.
+    None, then it is assumed to be a filename and the output produced while
+    testing (if 'trace_scores' is True) will be redirected to the file; the
+    summary statistics are still printed to stdout.
+
+    If 'batch' is True, 'nonsense_tester' must be a function that takes a
+    list of strings, such as is created by generate_nonsense_detector(...,
+    batch=True).  All the strings are then tested together in one call,
+    which is much faster, and those it masks as too short are skipped.
 
     This returns a tuple of multiple values, as follows:
         number of true positives
@@ -769,8 +1239,7 @@ def test_unlabeled(input, nonsense_tester, min_length=6, sense='valid',
     it will always return 0 true negatives and 0 false positives.
     '''
     from time import time
-    from contextlib import redirect_stdout
-    import humanize
+    from contextlib import redirect_stdout, nullcontext
 
     def run_tests(trace_scores):
         skipped = 0
@@ -779,21 +1248,29 @@ def test_unlabeled(input, nonsense_tester, min_length=6, sense='valid',
         fp = 0                          # false positives
         fn = 0                          # false negatives
         start = time()
-        for text in id_list:
-            try:
-                junk = nonsense_tester(text, trace_scores)
-                # This uses the fact that True == 1 in Python numeric contexts.
-                if sense != 'valid':
-                    # It's supposed to be nonsense.
-                    tp += junk       # true positive
-                    fn += not junk   # false negative
-                else:
-                    # It's not supposed to be nonsense.
-                    tn += not junk   # true negative
-                    fp += junk       # false positive
-            except:
-                skipped += 1
-
+        # Only the number of strings labeled as nonsense is counted while
+        # testing; which of the totals that gives depends on 'sense'.
+        if batch:
+            results = nonsense_tester(id_list, trace_scores)
+            skipped = int(np.ma.count_masked(results))
+            junk = int(np.count_nonzero(np.ma.filled(results, False)))
+        else:
+            junk = 0
+            for text in id_list:
+                try:
+                    # This uses the fact that True == 1 in Python numeric contexts.
+                    junk += nonsense_tester(text, trace_scores)
+                except:
+                    skipped += 1
+        tested = len(id_list) - skipped
+        if sense != 'valid':
+            # It's supposed to be nonsense.
+            tp = junk                   # true positives
+            fn = tested - junk          # false negatives
+        else:
+            # It's not supposed to be nonsense.
+            tn = tested - junk          # true negatives
+            fp = junk                   # false positives
         elapsed_time = time() - start
         return (tp, tn, fp, fn, skipped, elapsed_time)
 
@@ -802,12 +1279,10 @@ def test_unlabeled(input, nonsense_tester, min_length=6, sense='valid',
         total_tested = count
         accuracy = 100*(tp + tn)/count
         fmeasure = 2 * tp/(2*tp + fp + fn)
-        _msg('{:.2f}% accuracy ({} tested in {:.2f}s, '
-             '{} true pos, {} true neg, {} false pos, {} false neg, {} skipped)'
-             .format(accuracy, humanize.intcomma(total_tested), elapsed_time,
-                     humanize.intcomma(tp), humanize.intcomma(tn),
-                     humanize.intcomma(fp), humanize.intcomma(fn),
-                     humanize.intcomma(skipped)))
+        _msg('{:.2f}% accuracy ({:,} tested in {:.2f}s, '
+             '{:,} true pos, {:,} true neg, {:,} false pos, {:,} false neg, {:,} skipped)'
+             .format(accuracy, total_tested, elapsed_time,
+                     tp, tn, fp, fn, skipped))
 
     if isinstance(input, list):
         id_list = input
@@ -819,23 +1294,18 @@ def test_unlabeled(input, nonsense_tester, min_length=6, sense='valid',
     else:
         raise ValueError('First argument not understood: {}'.format(input))
 
-    if save_to:
-        with open(save_to, "w") as f:
-            with redirect_stdout(f):
-                (tp, tn, fp, fn, skipped, time) = run_tests(trace_scores=True)
-        _msg('-'*70)
-        if trace_scores:
-            print_stats(tp, tn, fp, fn, skipped, time)
-        return (tp, tn, fp, fn, skipped, time)
-    else:
-        (tp, tn, fp, fn, skipped, time) = run_tests(trace_scores=trace_scores)
-        if trace_scores:
-            print_stats(tp, tn, fp, fn, skipped, time)
-        return (tp, tn, fp, fn, skipped, time)
+    with open(save_to, 'w') if save_to else nullcontext() as f:
+        with redirect_stdout(f) if save_to else nullcontext():
+            results = run_tests(trace_scores=trace_scores)
+    if trace_scores:
+        if save_to:
+            _msg('-'*70)
+        print_stats(*results)
+    return results
 
 
 def test_labeled(input_file, nonsense_tester, min_length=6, trace_scores=False,
-                 save_to=None):
+                 save_to=None, batch=False):
     '''Test against a file containing labeled test cases.  'nonsense_tester'
     is a function that should return True if a given string is nonsense.
     Each line in the 'input_file' is assumed to contain two items separated
@@ -848,97 +1318,146 @@ def test_labeled(input_file, nonsense_tester, min_length=6, trace_scores=False,
        (list_false_pos, list_false_neg, num_tested, num_skipped, elapsed_time)
     If the argument 'save_to' is not None, then it is assumed to be a
     filename and any and all stdout output will be redirected to the file.
+    If 'batch' is True, 'nonsense_tester' must take a list of strings, as
+    for test_unlabeled(), and the strings it masks as too short are skipped.
     '''
     from time import time
-    from contextlib import redirect_stdout
-    import humanize
+    from contextlib import redirect_stdout, nullcontext
+    import csv
 
     labeled_as_nonsense = nonsense_tester
     def run_tests(filename, trace_scores):
-        with open(os.path.join(os.getcwd(), filename), 'r') as f:
+        with open(os.path.join(os.getcwd(), filename), 'r', newline='') as f:
             tp = 0
             tn = 0
             fp_list = []
             fn_list = []
             skipped = 0
             count = 0
-            lines = f.readlines()
+            # The rows are read as they are tested, so the time includes
+            # reading the file.
             start = time()
-            for line in lines:
-                column = line.strip().split(',')
-                known_real = (column[0] == 'y')
-                s = column[1]
-                try:
-                    count += 1
-                    if known_real:
-                        if labeled_as_nonsense(s, trace_scores):
-                            fp_list.append(s)
-                        else:
-                            tn += 1
-                    else:
-                        if labeled_as_nonsense(s, trace_scores):
-                            tp += 1
+            if batch:
+                # Load the columns into arrays and tally with Boolean masks.
+                columns = list(csv.reader(f))
+                count = len(columns)
+                strings = np.array([column[1] for column in columns], dtype=object)
+                known_real = np.array([column[0] == 'y' for column in columns],
+                                      dtype=bool)
+                results = labeled_as_nonsense(strings.tolist(), trace_scores)
+                tested = ~np.ma.getmaskarray(results)
+                skipped = count - int(np.count_nonzero(tested))
+                junk = np.ma.filled(results, False)
+                tp = int(np.count_nonzero(~known_real & junk))
+                tn = int(np.count_nonzero(known_real & tested & ~junk))
+                fp_list = strings[known_real & junk].tolist()
+                fn_list = strings[~known_real & tested & ~junk].tolist()
+            else:
+                for column in csv.reader(f):
+                    known_real = (column[0] == 'y')
+                    s = column[1]
+                    try:
+                        count += 1
+                        if known_real:
+                            if labeled_as_nonsense(s, trace_scores):
+                                fp_list.append(s)
+                            else:
+                                tn += 1
                         else:
-                            fn_list.append(s)
-                except:
-                    skipped += 1
+                            if labeled_as_nonsense(s, trace_scores):
+                                tp += 1
+                            else:
+                                fn_list.append(s)
+                    except:
+                        skipped += 1
             elapsed_time = time() - start
             if trace_scores:
                 fp = len(fp_list)
                 fn = len(fn_list)
                 precision = tp/(tp + fp)
                 recall = tp/(tp + fn)
-                _msg('{} tested in {:.2f}s, {} skipped -- '
+                _msg('{:,} tested in {:.2f}s, {:,} skipped -- '
                      '{:.2f}% precision, {:.2f}% recall, '
-                     '{} true pos, {} true neg, {} false pos, {} false neg'
-                     .format(humanize.intcomma(count), elapsed_time,
-                             humanize.intcomma(skipped), 100*precision, 100*recall,
-                             humanize.intcomma(tp), humanize.intcomma(tn),
-                             humanize.intcomma(fp), humanize.intcomma(fn)))
+                     '{:,} true pos, {:,} true neg, {:,} false pos, {:,} false neg'
+                     .format(count, elapsed_time, skipped, 100*precision,
+                             100*recall, tp, tn, fp, fn))
             return (fp_list, fn_list, count, skipped, elapsed_time)
 
-    if save_to:
-        with open(save_to, "w") as f:
-            with redirect_stdout(f):
-                return run_tests(input_file, trace_scores=trace_scores)
-    else:
-        return run_tests(input_file, trace_scores=trace_scores)
-
-
-def tabulate_scores(string_list, ngram_freq, show=50, portion='all',
-                    order='descending', precomputed=None, doreturn=False):
-    from operator import itemgetter
+    with open(save_to, 'w') if save_to else nullcontext() as f:
+        with redirect_stdout(f) if save_to else nullcontext():
+            return run_tests(input_file, trace_scores=trace_scores)
+
+
+def tabulate_scores(string_list, ngram_freq=None, show=50, portion='all',
+                    order='descending', precomputed=None, doreturn=False,
+                    score_function=None, score_len_threshold=25,
+                    score_len_penalty_exp=0.9233, score_rep_penalty_exp=0.9674):
+    '''Print a table of the n-gram scores of the strings in 'string_list'.
+    The strings are scored by 'score_function', which must be a batch
+    scoring function such as is returned by _tfidf_score_function(...,
+    batch=True).  If it is None, one is created from 'ngram_freq' (or from
+    the default n-gram data file, if 'ngram_freq' is None too) using the
+    arguments 'score_len_threshold', 'score_len_penalty_exp' and
+    'score_rep_penalty_exp', whose defaults are the same as those of
+    generate_nonsense_detector().  If 'precomputed' is given, it must be a
+    list of [string, score] pairs and is used instead of scoring
+    'string_list'.
+
+    If 'show' is an integer, it sets the number of rows shown: either evenly
+    spaced through the sorted list (if 'portion' is 'all') or taken from the
+    'top' or 'bottom' of it.  Otherwise, 'show' is taken to be a string and
+    only rows for that string are shown.  If 'doreturn' is True, the full
+    sorted list of [string, score] pairs is returned.
+    '''
     from tabulate import tabulate
     if precomputed:
-        sorted_scores = sorted(precomputed, key=itemgetter(1),
-                               reverse=not(order.startswith('ascend')))
+        string_list = [row[0] for row in precomputed]
+        scores = np.array([row[1] for row in precomputed], dtype=np.float64)
     else:
-        scores = []
-        ngram_length = len(next(iter(ngram_freq.keys())))
-        max_frequency = _highest_total_frequency(ngram_freq)
-        for s in string_list:
-            score = string_score(s, ngram_freq, ngram_length, max_frequency)
-            scores.append([s, score])
-        sorted_scores = sorted(scores, key=itemgetter(1),
-                               reverse=not(order.startswith('ascend')))
+        if score_function is None:
+            if ngram_freq is None:
+                ngram_freq = _ngram_array_from_pickle(_full_path('ngram_data.pklz'))
+            score_function = _tfidf_score_function(
+                ngram_freq, len_threshold=score_len_threshold,
+                len_penalty_exp=score_len_penalty_exp,
+                repetition_penalty_exp=score_rep_penalty_exp, batch=True)
+        scores = score_function([sanitize_string(s) for s in string_list])
+    keys = scores if order.startswith('ascend') else -scores
+    if (isinstance(show, int) and portion in ['top', 'bottom'] and not doreturn
+            and 0 < show < len(keys)):
+        # Only the rows to be shown need to be sorted.  Partitioning finds
+        # the cutoff value; rows tied with it are all kept, so that the
+        # stable sort below orders them the same as a full sort would.
+        if portion == 'top':
+            cutoff = np.partition(keys, show - 1)[show - 1]
+            indexes = np.flatnonzero(keys <= cutoff)
+        else:
+            cutoff = np.partition(keys, len(keys) - show)[len(keys) - show]
+            indexes = np.flatnonzero(keys >= cutoff)
+        indexes = indexes[np.argsort(keys[indexes], kind='stable')]
+    else:
+        indexes = np.argsort(keys, kind='stable')
+    sorted_scores = [[string_list[i], scores[i]] for i in indexes]
     if isinstance(show, int):
         if portion == 'all':
-            show_scores = sorted_scores[0::int(len(sorted_scores)/show)]
+            # With fewer rows than 'show', every row is shown.
+            step = max(1, len(sorted_scores)//show)
+            show_scores = sorted_scores[::step]
         elif portion == 'top':
             show_scores = sorted_scores[:show]
         else:
             show_scores = sorted_scores[-show:]
     else:
-        show_scores = [s for s in sorted_scores if s[0] == show]
+        show_scores = [row for row in sorted_scores if row[0] == show]
     print('-'*70)
     if isinstance(show, int):
-        print('Showing {} values sorted by {} column'.format(show, ordinal(1)))
-    print(tabulate(show_scores, tablefmt=format, headers=['String', 'score ']))
+        print('Showing {} values sorted by score'.format(show))
+    print(tabulate(show_scores, headers=['String', 'score ']))
     print('-'*70)
     if doreturn:
         return sorted_scores
 
-
+
 # Module exports.
 # .............................................................................
 
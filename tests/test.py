@@ -25,12 +25,59 @@ assert nonsense('iuewrofahgalkfgaufpiupqrjf')
 assert nonsense('ieeoienkjadfakj')
 assert nonsense('lalalaalkjuogaajfajlfal')
 
+nonsense_batch = generate_nonsense_detector(batch=True)
+assert list(nonsense_batch(['lakdfqtajaklj', 'ieeoienkjadfakj', 'sequenceofwords'])) == [True, True, False]
+assert nonsense_batch(['lakdfqtajaklj', 'abc']).mask.tolist() == [False, True]
+
+# Training counts only n-grams within runs of letters, and counts repeats of
+# a string once in string frequencies.  Check both with and without Numba.
+from math import log
+import nostril.nonsense_detector as detector
+training = ['Hello, world!', 'hello world', 'yellow', 'yellow', 'low-low']
+numba_available = detector._NUMBA_AVAILABLE
+for use_numba in sorted({False, numba_available}):
+    detector._NUMBA_AVAILABLE = use_numba
+    values = detector._ngram_values(training, 3)
+    assert values['hel'] == NGramData(2, 2, log(5/3, 2))
+    assert values['ell'] == NGramData(3, 4, log(5/4, 2))
+    assert values['yel'] == NGramData(1, 2, log(5/2, 2))
+    assert values['low'] == NGramData(2, 4, log(5/3, 2))
+    # N-grams that do not occur get the ceiling of the highest IDF.
+    assert values['owo'] == values['lor'] == values['zzz'] == NGramData(0, 0, 2)
+detector._NUMBA_AVAILABLE = numba_available
+
+# Every IDF value is 0 when trained on only two strings.
+tiny_freq = detector._ngram_values(['hello', 'world'], 4)
+assert not generate_nonsense_detector(ngram_freq=tiny_freq)('sequenceofwords')
+
+# tabulate_scores() must score strings the way the detector does, and must
+# show the same 'top' and 'bottom' rows as a full sort, including ties.
+import io
+from contextlib import redirect_stdout
+with redirect_stdout(io.StringIO()):
+    rows = detector.tabulate_scores(['a'*65, 'sequenceofwords'], doreturn=True)
+assert round(dict(rows)['a'*65], 2) == 5.78
+def tabulated(**kwargs):
+    output = io.StringIO()
+    precomputed = [['s{}'.format(i), float(i % 4)] for i in range(12)]
+    with redirect_stdout(output):
+        detector.tabulate_scores([], precomputed=precomputed, **kwargs)
+    return output.getvalue()
+for portion in ['top', 'bottom']:
+    for order in ['ascending', 'descending']:
+        assert (tabulated(show=5, portion=portion, order=order)
+                == tabulated(show=5, portion=portion, order=order, doreturn=True))
+assert tabulated(show=4, portion='all').count('\ns') == 4
+assert tabulated(show=50, portion='all').count('\ns') == 12
+
 print('Testing labeled cases -- expect 6 false positives, 5 false negatives:')
 result = test_labeled('labeled-cases/real-not-real.csv', nonsense, trace_scores=True)
+assert test_labeled('labeled-cases/real-not-real.csv', nonsense_batch, batch=True)[:4] == result[:4]
 
 print('')
 print('Testing against valid Ludiso cases -- expect 6 false positives:')
-test_unlabeled('unlabeled-cases/ludiso.txt', nonsense, trace_scores=True)
+result = test_unlabeled('unlabeled-cases/ludiso.txt', nonsense, trace_scores=True)
+assert test_unlabeled('unlabeled-cases/ludiso.txt', nonsense_batch, batch=True)[:5] == result[:5]
 
 print('')
 print('Testing against valid OSX identifiers -- expect 5 false positives:')